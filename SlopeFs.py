@@ -1,7 +1,81 @@
-from typing import Optional, Dict, Tuple, List
+from typing import Optional, Dict, Tuple, List, Mapping
+from types import MappingProxyType
+import functools
 import math
 import numpy as np
-import scipy as sp
+from scipy.optimize import minimize, newton
+from numba import njit
+
+
+@njit(cache=True, fastmath=True)
+def _fellenius_sums(poly_x, poly_y, c, slen, n, gam, tan_phi, u):
+    """
+        Numerator and denominator of the Fellenius factor of safety, computed straight from the polygon columns.
+        Areas (shoelace) and alphas of each slice are accumulated in a single pass.
+    """
+    s1 = 0.0
+    s2 = 0.0
+    for i in range(poly_x.shape[0]):
+        a = 0.0
+        for j in range(4):
+            k = (j + 1) % 4
+            a += poly_x[i, j] * poly_y[i, k] - poly_x[i, k] * poly_y[i, j]
+        are = 0.5 * abs(a)
+
+        alp = math.atan2(poly_y[i, 0] - poly_y[i, 3], poly_x[i, 0] - poly_x[i, 3])
+
+        s1 += c * slen / n + (gam * are * math.cos(alp) - u * slen) * tan_phi
+        s2 += gam * are * math.sin(alp)
+
+    return s1, s2
+
+
+class InvalidCircleError(ValueError):
+    """
+        Raised when the circle doesn't cut a valid slice of the slope.
+        The optimizer treats it as a bad circle, any other error is a bug and propagates.
+    """
+
+
+class SoilProps:
+    """
+        SoilProps Class:
+            Holds the soil and slope properties as slotted attributes.
+            Angles are stored in radians, together with their cached tangents.
+        Uses:
+            Read by Model and SoilFs on every step of the optimizer, where attribute access beats a dict lookup.
+    """
+
+    __slots__ = ('c', 'phi', 'gam', 'alp', 'h', 'num_slice', 'slope_len',
+                 'tan_alp', 'tan_phi', 'circle')
+
+    # Cached from other fields, left out of as_dict()
+    _derived = ('tan_alp', 'tan_phi')
+
+    def __init__(self, c, phi, gam, alp, h, num_slice):
+        self.c = c
+        self.phi = phi
+        self.gam = gam
+        self.alp = alp
+        self.h = h
+        self.num_slice = num_slice
+
+        self.slope_len = None
+        self.tan_alp = None
+        self.tan_phi = None
+        self.circle: Optional[Dict[str, float]] = None
+
+    def key(self) -> Tuple:
+        """
+            Hashable snapshot of every field except the circle, used to key cached results on the soil.
+        """
+        return tuple(getattr(self, name) for name in self.__slots__ if name != 'circle')
+
+    def as_dict(self) -> Dict:
+        props = {name: getattr(self, name) for name in self.__slots__ if name not in self._derived + ('circle',)}
+        props['Circle'] = self.circle
+
+        return props
 
 
 class SoilSpace:
@@ -15,31 +89,47 @@ class SoilSpace:
             Default values present to simplify analysing behaviour
     """
 
-    def __init__(self, c=20, phi=30, gam=18.5, alp=45, h=15, num_slice=50, circle: Dict[str, float] = None):
-        self.properties = {
-            'c': c,
-            'phi': math.radians(phi),
-            'gam': gam,
-            'alp': math.radians(alp),
-            'h': h,
-            'num_slice': num_slice
-        }
+    def __init__(self, c=20, phi=30, gam=18.5, alp=45, h=15, num_slice=50, circle: Dict[str, float] = None,
+                 verbose=False):
+        self.verbose = verbose
+        self.props = SoilProps(c, math.radians(phi), gam, math.radians(alp), h, num_slice)
 
+        self.update_trig()
         self.update_slope_len()
         self.update_circle(self, circle)
 
+    @property
+    def properties(self) -> Mapping:
+        """
+            Read-only view of the properties, fields are changed through self.props.
+        """
+        return MappingProxyType(self.props.as_dict())
+
+    def update_trig(self):
+        """
+            Caches the tangents of the slope and friction angles.
+            They derive from alp and phi, so the properties view leaves them out.
+        """
+        self.props.tan_alp = math.tan(self.props.alp)
+        self.props.tan_phi = math.tan(self.props.phi)
+
     def update_slope_len(self):
-        self.properties['slope_len'] = self.properties['h'] / math.tan(self.properties['alp'])
+        self.props.slope_len = self.props.h / self.props.tan_alp
 
     @staticmethod
-    def update_circle(self, circle):
+    def update_circle(self, circle, verbose: Optional[bool] = None):
+        """
+            Sets the circle, the default one when circle is empty.
+            verbose overrides the soil's own flag for this call, SoilFs uses it to pass its flag down.
+        """
         if not circle:
-            xc = 0.5 * self.properties['h'] / math.tan(self.properties['alp'])
-            yc = 1.333 * self.properties['h']
+            xc = 0.5 * self.props.h / self.props.tan_alp
+            yc = 1.333 * self.props.h
             r = 1 * math.sqrt(xc ** 2 + yc ** 2)
         else:
             keys = list(circle.keys())
-            assert ('xc' in keys and 'yc' in keys and 'R' in keys), f'Invalid keys {keys}'
+            if not ('xc' in keys and 'yc' in keys and 'R' in keys):
+                raise ValueError(f'Invalid keys {keys}')
             xc = circle['xc']
             yc = circle['yc']
             r = circle['R']
@@ -50,8 +140,11 @@ class SoilSpace:
             'R': r
         }
 
-        print(circle)
-        self.properties['Circle'] = circle
+        if verbose is None:
+            verbose = self.verbose
+        if verbose:
+            print(circle)
+        self.props.circle = circle
 
     def __str__(self):
         return f'{self.properties}'
@@ -68,16 +161,41 @@ class Model:
             sl = SoilSpace()
 
         self.soil = sl
-        self.sl: Dict[str, float] = sl.properties
+        self.sl: SoilProps = sl.props
 
-        self.circle: Dict[str, float] = self.sl['Circle']
+        self._alloc_buffers(self.sl.num_slice)
+        self._rebuild_geometry()
 
-        self.points: Tuple[Tuple, Tuple] = self.intersec()
-        self.c_points: List[Tuple] = self.split_geometry()
-        self.polys: List[np.array] = self.mk_polys()
+    def _alloc_buffers(self, ns: int):
+        self._steps: np.ndarray = np.arange(ns + 1, dtype=np.float64)
+        self._angles: np.ndarray = np.empty(ns + 1, dtype=np.float64)
+        self.c_points: np.ndarray = np.empty((ns + 1, 2), dtype=np.float64)
+        self.poly_x: np.ndarray = np.empty((ns, 4), dtype=np.float64)
+        self.poly_y: np.ndarray = np.empty((ns, 4), dtype=np.float64)
+
+    def update_circle(self, xc: float, yc: float, r: float, verbose: Optional[bool] = None):
+        """
+            Moves the circle and recomputes only what depends on it.
+            The soil properties and the preallocated arrays are reused.
+            verbose is passed on to SoilSpace.update_circle.
+        """
+        circle = {
+            'xc': xc,
+            'yc': yc,
+            'R': r
+        }
+        self.soil.update_circle(self.soil, circle, verbose)
+        self._rebuild_geometry()
+
+    def _rebuild_geometry(self):
+        if self.poly_x.shape[0] != self.sl.num_slice:
+            self._alloc_buffers(self.sl.num_slice)
 
-        self.dxs, self.alphas = self.calc_alphas()
-        self.polys_A: List[float] = self.calc_areas()
+        self.circle: Dict[str, float] = self.sl.circle
+
+        self.points: Tuple[Tuple, Tuple] = self.intersec()
+        self.split_geometry()
+        self.mk_polys()
 
     def intersec(self) -> Tuple[Tuple, Tuple]:
         """
@@ -85,9 +203,9 @@ class Model:
             It uses second degree equations to find the intersections.
             It returns the points in order from left to right.
         """
-        t = math.tan(self.sl['alp'])
-        h = self.sl['h']
-        l = self.sl['slope_len']
+        t = self.sl.tan_alp
+        h = self.sl.h
+        l = self.sl.slope_len
         r, xc, yc = self.circle['R'], self.circle['xc'], self.circle['yc']
 
         a = 1 + t ** 2
@@ -97,15 +215,22 @@ class Model:
 
         delta = b ** 2 - 4 * a * c
 
-        assert delta > 0, f'Math error, delta:{delta} <= 0, Circle doesn\'t intersect slope.'
+        if delta <= 0:
+            raise InvalidCircleError(f'Math error, delta:{delta} <= 0, Circle doesn\'t intersect slope.')
 
         def f(x):
             if 0 < x < l:
                 return x, t * x
-            elif x < 0:
-                return xc - math.sqrt(r ** 2 - yc ** 2), 0
+            elif x <= 0:
+                d = r ** 2 - yc ** 2
+                if d < 0:
+                    raise InvalidCircleError(f'Math error, r:{r} < yc:{yc}, Circle doesn\'t reach the ground.')
+                return xc - math.sqrt(d), 0
             else:
-                return xc + math.sqrt(r ** 2 + 2 * h * yc - h ** 2 - yc ** 2), h
+                d = r ** 2 + 2 * h * yc - h ** 2 - yc ** 2
+                if d < 0:
+                    raise InvalidCircleError(f'Math error, r:{r} < |yc - h|, Circle doesn\'t reach the crest.')
+                return xc + math.sqrt(d), h
 
         x1 = (-b + math.sqrt(delta)) / (2 * a)
         x2 = (-b - math.sqrt(delta)) / (2 * a)
@@ -118,114 +243,93 @@ class Model:
 
         return p_l, p_r
 
-    def split_geometry(self) -> List[Tuple]:
+    def split_geometry(self) -> np.ndarray:
         """
             It splits the circle into equal parts based on the number of slices given.
-            Together there is the total_angle method, it measures the total angle of the intersection points.
-            It returns a list of tuples containing the points.
-            One thing might be removed, in the definition of f() there is a rounding done with the map() function.
+            Together there is the total_angle method, it measures the total angle of the intersection points
+            from the cross and dot products of their radii, which stays accurate for small angles.
+            The points are written in place into the preallocated (ns+1)x2 self.c_points, which is also returned.
         """
-        # a = math.tan(self.sl['alp'])
         p_l, p_r = self.points
         r, xc, yc = self.circle['R'], self.circle['xc'], self.circle['yc']
-        ns = self.sl['num_slice']
-
-        v_p_r = np.array(p_r)
-        v_c = np.array([xc, yc])
+        ns = self.sl.num_slice
 
         def total_angle(p1, p2, xc, yc):
-            dist = lambda p1, p2: math.sqrt((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2)
-            ct = (xc, yc)
-            a, b, c = dist(p1, p2), dist(p1, ct), dist(p2, ct)
-            tot_angle = math.acos(-(a ** 2 - (b ** 2 + c ** 2)) / (2 * b * c))
+            v1 = (p1[0] - xc, p1[1] - yc)
+            v2 = (p2[0] - xc, p2[1] - yc)
+            cross = v1[0] * v2[1] - v1[1] * v2[0]
+            dot = v1[0] * v2[0] + v1[1] * v2[1]
+            tot_angle = abs(math.atan2(cross, dot))
 
             return tot_angle
 
         tot_a = total_angle(p_l, p_r, xc, yc)
         alp = tot_a / ns
-        gam = math.atan(abs((v_c[1] - v_p_r[1]) / (v_c[0] - v_p_r[0])))
+        gam = math.atan2(abs(yc - p_r[1]), abs(xc - p_r[0]))
+
+        angles = self._angles
+        np.multiply(self._steps, alp, out=angles)
+        angles += gam
+        np.negative(angles, out=angles)
+
+        pts = self.c_points
+        pts_x, pts_y = pts[:, 0], pts[:, 1]
+        np.cos(angles, out=pts_x)
+        np.sin(angles, out=pts_y)
+        pts_x *= r
+        pts_x += xc
+        pts_y *= r
+        pts_y += yc
 
-        f = lambda n: map(lambda x: round(x, 2),
-                          r * np.array([math.cos(-(gam + n * alp)), math.sin(-(gam + n * alp))]) + v_c)
-        return [tuple(f(n)) for n in range(ns + 1)]
+        return pts
 
-    def mk_polys(self) -> List[Tuple]:
+    def mk_polys(self) -> Tuple[np.ndarray, np.ndarray]:
         """
             This method creates the polygons whose areas are going to be calculated.
             It takes the list of points in the circle, reflects them into the corresponding part of the surface.
-            Together with it there is the pair_points method, which takes the previous points and orders them counter-clockwise.
-            It returns an array of 4x1 arrays with the points .
+            Each polygon is ordered counter-clockwise: circle point, its surface point, the next surface point and the next circle point.
+            The polygons are stored as columns, poly_x and poly_y are Nx4 arrays written in place and returned.
         """
         c_parts = self.c_points
-        pts_x, pts_y = zip(*c_parts)
-        a = self.sl['alp']
-        h = self.sl['h']
-        l = self.sl['slope_len']
-
-        def f(x):
-            if 0 <= x <= l:
-                return round(a * x, 2)
-            elif x > l:
-                return h
-            else:
-                return 0
-
-        up_c_parts = [(x, f(x)) for x in pts_x]
-
-        full_points = [c_parts, up_c_parts]
-
-        def pair_points(points):
-            polys = []
-            for i in range(0, len(points[0])):
-                try:
-                    polys.append([points[0][i], points[1][i], points[1][i + 1], points[0][i + 1]])
-                except IndexError:
-                    pass
-
-            return np.array(polys)
-
-        return pair_points(full_points)
-
-    def calc_alphas(self):
+        pts_x, pts_y = c_parts[:, 0], c_parts[:, 1]
+        a = self.sl.tan_alp
+        h = self.sl.h
+        l = self.sl.slope_len
+
+        up_y = np.where(pts_x < 0, 0.0, np.where(pts_x > l, h, a * pts_x))
+
+        poly_x, poly_y = self.poly_x, self.poly_y
+        poly_x[:, 0] = pts_x[:-1]
+        poly_x[:, 1] = pts_x[:-1]
+        poly_x[:, 2] = pts_x[1:]
+        poly_x[:, 3] = pts_x[1:]
+        poly_y[:, 0] = pts_y[:-1]
+        poly_y[:, 1] = up_y[:-1]
+        poly_y[:, 2] = up_y[1:]
+        poly_y[:, 3] = pts_y[1:]
+
+        return poly_x, poly_y
+
+    def calc_alphas(self) -> Tuple[np.ndarray, np.ndarray]:
         """
             Alpha angle of each slice of the circle (each polygon).
-            Utilizes the arctan(x).
+            Utilizes the arctan2(y, x), which stays defined for vertical slices.
         """
-
-        polys = self.polys
-        alp = lambda dy, dx: math.atan(dy / dx)
-        n_polys = polys.shape[0]
-
-        # Potential performance lost
-        alphas = []
-        dxs = []
-        for i in range(n_polys):
-            dy = polys[i][0][1] - polys[i][-1][1]
-            dx = polys[i][0][0] - polys[i][-1][0]
-
-            dxs.append(dx)
-            alphas.append(alp(dy, dx))
+        dxs = self.poly_x[:, 0] - self.poly_x[:, 3]
+        dys = self.poly_y[:, 0] - self.poly_y[:, 3]
+        alphas = np.arctan2(dys, dxs)
 
         return dxs, alphas
 
-    def calc_areas(self) -> List[float]:
+    def calc_areas(self) -> np.ndarray:
         """
             It calculates the areas of the polygons.
             It uses the shoelace formula for calculating the area.
             It returns an array containing the areas of each of the polygons.
         """
-        p = self.polys
-
-        areas = []
+        x, y = self.poly_x, self.poly_y
 
-        for poly in p:
-            n = len(poly)
-            a = 0
-            for i in range(n):
-                x1, y1 = poly[i]
-                x2, y2 = poly[(i + 1) % n]
-                a += (x1 * y2 - x2 * y1) / 2
-            areas.append(a)
+        areas = 0.5 * np.abs(np.sum(x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y, axis=1))
 
         return areas
 
@@ -237,12 +341,18 @@ class SoilFs:
         Houses methods for showing and analyzing data.
     """
 
-    def __init__(self, soil: Optional[SoilSpace] = None):
+    # Returned by fellenius_call for circles with no valid geometry, well above any real FS
+    INVALID_FS = 1e3
+
+    def __init__(self, soil: Optional[SoilSpace] = None, verbose=False):
         if not soil:
             soil = SoilSpace()
 
+        self.verbose = verbose
         self.soil = soil
-        self.sl = soil.properties
+        self.sl = soil.props
+        self.model = Model(self.soil)
+        self._fellenius_at = functools.lru_cache(maxsize=256)(self._fellenius_eval)
         self.results = self.end_results()
         self.fs = {'Fellenius': self.results.fun
         }
@@ -253,74 +363,93 @@ class SoilFs:
             Bishop is an implicit equation, its roots are found using Newton's method (via Scipy.optimize)
             It returns both values in a dictionary format, according to the format used by the SoilSpace class.
         """
-        c0 = list(self.sl['Circle'].values())
-        model_0 = Model(self.soil)
-        fs = self.fellenius(model_0)
+        self._fellenius_at.cache_clear()
+        c0 = list(self.sl.circle.values())
+        fs = self.fellenius(self.model)
         print(f"Inicial {fs}")
 
         return (
-            sp.optimize.minimize(self.fellenius_call, x0=c0,method='SLSQP')
+            minimize(self.fellenius_call, x0=c0, method='L-BFGS-B', bounds=self.circle_bounds(),
+                     options={'ftol': 1e-6, 'maxls': 50})
         )
 
+    def circle_bounds(self) -> List[Tuple[Optional[float], Optional[float]]]:
+        """
+            Box for (xc, yc, R) searched by the optimizer.
+            It only rules out circles that can't be valid: a centre below the ground or a non-positive radius.
+            The centre is kept within one slope length of the slope, the critical circle sits near the toe.
+            Circles inside the box that still miss the slope are penalized by fellenius_call.
+        """
+        l = self.sl.slope_len
+
+        return [(-l, 2 * l), (0, None), (0, None)]
+
     def fellenius_call(self, c0: List[float]):
-        circle = {
-            'xc': c0[0],
-            'yc': c0[1],
-            'R': c0[2]
-        }
-        print(c0)
-        self.soil.update_circle(self.soil, circle)
-        model = Model(self.soil)
+        """
+            Objective of the optimizer, memoized on the soil fields and the circle.
+            The circle isn't rounded for the key, the finite difference steps are about 1e-8 and rounding them
+            would bend the gradient.
+            A cache hit doesn't move the model, so self.model and soil.props.circle keep the last circle
+            that was actually rebuilt, which is not necessarily c0.
+        """
+        if self.verbose:
+            print(c0)
+
+        return self._fellenius_at(self.sl.key(), float(c0[0]), float(c0[1]), float(c0[2]))
 
-        return self.fellenius(model)
+    def _fellenius_eval(self, soil_key: Tuple, xc: float, yc: float, r: float):
+        """
+            Fellenius FS of a single circle, memoized by fellenius_call.
+            soil_key is only part of the cache key, so changing any soil field misses the old entries.
+            Circles that don't cut the slope get INVALID_FS, so the optimizer backs off instead of aborting.
+        """
+        try:
+            self.model.update_circle(xc, yc, r, verbose=self.verbose)
+            return self.fellenius(self.model)
+        except InvalidCircleError:
+            return self.INVALID_FS
 
     def bishop_call(self, c0):
-        circle = {
-            'xc': c0[0],
-            'yc': c0[1],
-            'R': c0[2]
-        }
-        print(c0)
-        self.soil.update_circle(self.soil, circle)
-        model = Model(self.soil)
+        if self.verbose:
+            print(c0)
+        self.model.update_circle(*c0, verbose=self.verbose)
 
-        return self.bishop(model)
+        return self.bishop(self.model)
 
     @staticmethod
     def fellenius(model: Model, u=0):
-        c = model.sl['c']
-        slen = model.sl['slope_len']
-        gam = model.sl['gam']
-        phi = model.sl['phi']
-        n = model.sl['num_slice']
-        are = model.polys_A
-        alp = model.alphas
-        size = len(are)
-
-        fell1 = sum(
-            [c * slen / n + (gam * are[i] * math.cos(alp[i]) - u * slen) * math.tan(phi) for i in range(size)])
-        fell2 = sum([gam * are[i] * math.sin(alp[i]) for i in range(size)])
+        sl = model.sl
+
+        fell1, fell2 = _fellenius_sums(model.poly_x, model.poly_y, sl.c, sl.slope_len, sl.num_slice, sl.gam,
+                                       sl.tan_phi, u)
+        if fell2 <= 0:
+            raise InvalidCircleError(f'Math error, driving moment:{fell2} <= 0, Circle doesn\'t cut a sliding mass.')
 
         fs = fell1 / fell2
         return fs
 
     @staticmethod
     def bishop(model):
-        c = model.sl['c']
-        gam = model.sl['gam']
-        phi = model.sl['phi']
-        are = model.polys_A
-        alp = model.alphas
-        dxs = model.dxs
-        size = len(are)
+        c = model.sl.c
+        gam = model.sl.gam
+        # Only Bishop needs the per-slice arrays, Fellenius reads the polygons directly
+        dxs, alp = model.calc_alphas()
+        are = model.calc_areas()
+        tan_phi = model.sl.tan_phi
+
+        # Terms that don't depend on fs
+        bip1 = (gam * are * np.sin(alp)).sum() ** -1
+        num = c * dxs + gam * are * tan_phi
+        cos_a = np.cos(alp)
+        sin_t = np.sin(alp) * tan_phi
 
         def bishop_calc(fs):
-            bip1 = (sum([gam * are[i] * math.sin(alp[i]) for i in range(size)])) ** -1
-            bip2 = sum([(c * dxs[i] + gam * are[i] * math.tan(phi)) / (
-                    math.cos(alp[i]) + math.sin(alp[i]) * math.tan(phi) / fs) for i in range(size)])
-            return fs - bip1 * bip2
+            return fs - bip1 * (num / (cos_a + sin_t / fs)).sum()
+
+        def bishop_prime(fs):
+            return 1 - bip1 * (num * sin_t / (fs * (cos_a + sin_t / fs)) ** 2).sum()
 
-        return sp.optimize.newton(bishop_calc, x0=2)
+        return newton(bishop_calc, x0=2, fprime=bishop_prime)
 
     def __str__(self):
         return f'{self.fs}'